@@ -5,14 +5,26 @@ from typing import Callable, Optional, Tuple, Union
 import time
 
 import clip
+import numpy as np
 import torch
 from clip.model import CLIP
 # from lavis.models import BlipFeatureExtractor, load_model_and_preprocess
 from PIL import Image
 from torch import Tensor, nn
-from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
+from torchvision import transforms as T
+from transformers import (
+    GPT2Config,
+    GPT2LMHeadModel,
+    GPT2Tokenizer,
+    GPT2TokenizerFast,
+)
+from transformers.convert_slow_tokenizer import convert_slow_tokenizer
 
 PreprocessorType = Callable[[Image.Image], Tensor]
+TokenizerType = Union[GPT2Tokenizer, GPT2TokenizerFast]
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
 
 
 class LanguageModels(Enum):
@@ -47,11 +59,11 @@ def load_language_model(
     return model
 
 
-def load_tokenizer(name: str) -> GPT2Tokenizer:
+def load_tokenizer(name: str) -> GPT2TokenizerFast:
     check_language_model(name)
     while True:
         try:
-            tokenizer = GPT2Tokenizer.from_pretrained(name)
+            tokenizer = GPT2TokenizerFast.from_pretrained(name)
             break
         # if fail, just retry
         except Exception as e:
@@ -63,6 +75,20 @@ def load_tokenizer(name: str) -> GPT2Tokenizer:
     return tokenizer
 
 
+def to_fast_tokenizer(tokenizer: TokenizerType) -> GPT2TokenizerFast:
+    """Converts a (slow, pure Python) 'GPT2Tokenizer' into the equivalent
+    'GPT2TokenizerFast'. Fast tokenizers are returned as-is.
+    """
+    if isinstance(tokenizer, GPT2TokenizerFast):
+        return tokenizer
+    return GPT2TokenizerFast(
+        tokenizer_object=convert_slow_tokenizer(tokenizer),
+        add_prefix_space=tokenizer.add_prefix_space,
+        model_max_length=tokenizer.model_max_length,
+        **tokenizer.special_tokens_map,
+    )
+
+
 class VisionBackbones(Enum):
     blip_base: str = "blip:base"
     clip_rn50: str = "clip:RN50"
@@ -83,6 +109,23 @@ def check_vision_backbone(backbone: str) -> None:
         raise ValueError(f"Unsupported backbone '{backbone}'. Allowed: {allowed}.")
 
 
+# Size of the image features from each vision backbone.
+VISION_BACKBONE_FEATURES = {
+    VisionBackbones.blip_base.value: 768,
+    VisionBackbones.clip_rn50.value: 1024,
+    VisionBackbones.clip_rn101.value: 512,
+    VisionBackbones.clip_vit_b32.value: 512,
+    VisionBackbones.clip_vit_b16.value: 512,
+    VisionBackbones.clip_vit_l14.value: 768,
+    VisionBackbones.clip_vit_l14_336px.value: 768,
+}
+
+
+def get_vision_backbone_features(backbone: str) -> int:
+    check_vision_backbone(backbone)
+    return VISION_BACKBONE_FEATURES[backbone]
+
+
 def load_vision_backbone(
     backbone: str, device: Optional[Union[str, torch.device]] = None
 ) -> Tuple[nn.Module, PreprocessorType]:
@@ -101,6 +144,41 @@ def load_vision_backbone(
         return clip.load(name, device=device, jit=False)
 
 
+def load_clip_tensor_preprocessor(
+    resolution: int, device: Optional[Union[str, torch.device]] = None
+) -> PreprocessorType:
+    """Equivalent of the CLIP preprocessor, which only decodes (and cheaply shrinks)
+    images to 'uint8' on the CPU. Resizing, cropping, and normalization run on
+    'device' instead.
+    """
+    transform = T.Compose(
+        [
+            T.Resize(
+                resolution,
+                interpolation=T.InterpolationMode.BICUBIC,
+                antialias=True,
+            ),
+            T.CenterCrop(resolution),
+            T.ConvertImageDtype(torch.float32),
+            T.Normalize(CLIP_MEAN, CLIP_STD),
+        ]
+    )
+
+    def preprocess(image: Image.Image) -> Tensor:
+        image = image.convert("RGB")
+        # Shrink large images by an integer factor (a fast box filter), keeping the
+        # short side at least 'resolution'. Otherwise, full-resolution photos would
+        # be copied to the device, which is more data than a resized float tensor.
+        factor = min(image.size) // resolution
+        if factor > 1:
+            image = image.reduce(factor)
+        array = np.array(image)
+        # (H, W, C) uint8 -> (C, H, W), after moving to the device
+        return transform(torch.from_numpy(array).to(device).permute(2, 0, 1))
+
+    return preprocess
+
+
 def encode_image_tensor(image: Tensor, backbone: nn.Module) -> Tensor:
     if False: # isinstance(backbone, BlipFeatureExtractor):
         features = backbone.extract_features({"image": image}, mode="image")
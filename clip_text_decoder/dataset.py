@@ -5,7 +5,6 @@ import pickle
 from tempfile import TemporaryDirectory
 from typing import Any, Iterable, List, Tuple
 
-import gdown
 from PIL import Image
 from torch import Tensor
 from torch.utils.data import Dataset
@@ -14,6 +13,7 @@ from tqdm import tqdm
 
 from clip_text_decoder.common import check_vision_backbone
 from clip_text_decoder.datapipes import ParallelImageEncoder, coco_captions_datapipe
+from clip_text_decoder.utils.download import download_file
 
 COCO_ANNOTATIONS_URL = (
     "http://images.cocodataset.org/annotations/annotations_trainval2014.zip"
@@ -75,7 +75,7 @@ class CocoCaptionsDataset(CachedDataset):
     def download(url: str) -> CocoCaptionsDataset:
         with TemporaryDirectory() as tempdir:
             path = os.path.join(tempdir, "cache.pkl")
-            gdown.download(url, path, quiet=False)
+            download_file(url, path)
             with open(path, "rb") as f:
                 data = pickle.load(f)
 
@@ -1,29 +1,65 @@
 from __future__ import annotations
 
+import copy
+import hashlib
+import inspect
 import os
-import tempfile
-from typing import Callable, List, Optional, Tuple, Union
+import weakref
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-import gdown
 import torch
 import torch.nn.functional as F
+from clip.model import CLIP
 from PIL import Image
 from pytorch_lightning import LightningModule
 from torch import Tensor, nn, optim
-from transformers import GPT2Tokenizer
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:  # transformers < 4.20
+    from transformers.modeling_utils import Conv1D
 
 from clip_text_decoder.common import (
+    TokenizerType,
     check_language_model,
     check_vision_backbone,
     encode_image_tensor,
+    get_vision_backbone_features,
+    load_clip_tensor_preprocessor,
     load_language_model,
     load_vision_backbone,
+    to_fast_tokenizer,
 )
+from clip_text_decoder.utils.download import download_file
 
 PRETRAINED_INFERENCE_MODEL_PATH = (
     "https://drive.google.com/uc?id=1bEAyV2279C4V4iYMaJahREiM58vjy6G1"
     # https://drive.google.com/file/d/1bEAyV2279C4V4iYMaJahREiM58vjy6G1/view?usp=sharing
 )
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "clip-text-decoder",
+)
+
+# Cached self-attention (key, value) tensors for each GPT2 layer, as returned by
+# the HuggingFace models when 'use_cache=True'.
+PastKeyValues = Tuple[Tuple[Tensor, ...], ...]
+
+
+def _conv1d_to_linear(module: nn.Module) -> None:
+    """Replaces the HuggingFace 'Conv1D' layers used by GPT2 with equivalent
+    'nn.Linear' layers (in place), so that they can be dynamically quantized.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = nn.Linear(in_features, out_features)
+            # Conv1D weights are stored as (in_features, out_features).
+            linear.weight = nn.Parameter(child.weight.t().contiguous())
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
 
 
 class Decoder(LightningModule):
@@ -47,27 +83,68 @@ class Decoder(LightningModule):
 
         self.to(device)
 
+    @property
+    def encoder_hidden_size(self) -> int:
+        """Size of the encoder features expected by the cross-attention layers."""
+        c_attn = self.language_model.transformer.h[0].crossattention.c_attn
+        if isinstance(c_attn, Conv1D):
+            return c_attn.weight.size(0)
+        # Linear layers, after 'DecoderInferenceModel.quantize_int8'
+        return c_attn.in_features
+
+    @torch.no_grad()
+    def fuse_encoder_padding(self, num_features: int) -> None:
+        """Specializes the cross-attention layers for encoder features of size
+        'num_features'. Zero-padded features only interact with the first
+        'num_features' rows of each key/value projection weight, so keeping just
+        those rows is equivalent to padding, and removes the pad from 'forward'.
+
+        NOTE: This changes the shapes in 'state_dict()', and replaces parameters in
+        place, so it's meant for inference only. Checkpoints of the unfused model
+        can't be loaded afterwards.
+        """
+        if num_features > self.encoder_hidden_size:
+            raise ValueError(
+                f"Can't fuse encoder features of size {num_features}, which is larger "
+                f"than the cross-attention input size ({self.encoder_hidden_size})."
+            )
+        # Parameters can't be inference tensors, in case we're in 'inference_mode'.
+        with torch.inference_mode(False):
+            for block in self.language_model.transformer.h:
+                c_attn = block.crossattention.c_attn
+                weight = c_attn.weight[:num_features].contiguous()
+                c_attn.weight = nn.Parameter(weight)
+
     def forward(
         self,
         input_ids: Tensor,
         encoder_hidden_states: Tensor,
         attention_mask: Optional[Tensor] = None,
         labels: Optional[Tensor] = None,
+        past_key_values: Optional[PastKeyValues] = None,
+        use_cache: Optional[bool] = None,
     ):
-        batch_size, _, num_features = encoder_hidden_states.shape
-        # TODO: Check if we can get '768' (num_features) from the GPT2 model.
-        hidden = torch.zeros(
-            size=(batch_size, 1, 1024),
-            dtype=encoder_hidden_states.dtype,
-            device=encoder_hidden_states.device,
-        )
-        hidden[:, :, :num_features] = encoder_hidden_states
+        # Zero-pad the encoder features up to the size expected by cross-attention.
+        # (A constant pad, rather than allocate + assign, is friendlier to tracing.)
+        # No padding is needed after 'fuse_encoder_padding', or for features that are
+        # already padded (see 'DecoderInferenceModel._get_encoder_hidden_buffer').
+        hidden = encoder_hidden_states
+        num_padding = self.encoder_hidden_size - encoder_hidden_states.size(-1)
+        if num_padding < 0:
+            raise ValueError(
+                f"Expected encoder features of size at most {self.encoder_hidden_size}, "
+                f"but got size {encoder_hidden_states.size(-1)}."
+            )
+        elif num_padding > 0:
+            hidden = F.pad(encoder_hidden_states, (0, num_padding))
 
         return self.language_model(
             input_ids=input_ids,
             encoder_hidden_states=hidden,
             attention_mask=attention_mask,
             labels=labels,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
         )
 
     def configure_optimizers(self):
@@ -111,133 +188,632 @@ class Decoder(LightningModule):
         return result.loss
 
 
+class _DecodeStepGraph:
+    """A captured CUDA graph for one single-token decoding step, with a fixed batch
+    size and cache length. The captured kernels always read from (and write to) the
+    same memory, so the tensors given here are used as static buffers. Callers copy
+    new values into them before each replay.
+
+    The key/value cache stays in 'past_key_values' between steps. Each replay first
+    reorders it in place, so that row 'i' holds the cache of beam 'parents[i]' from
+    the previous step. 'past_key_values' has room for one more token than the cache
+    being read, and the graph writes the new keys/values into that last position,
+    and the logits into 'logits'. So none of its outputs live in the graph's memory
+    pool. Only temporaries do, which lets graphs safely share a pool (see 'pool').
+    """
+
+    def __init__(
+        self,
+        model: Decoder,
+        input_ids: Tensor,
+        parents: Tensor,
+        encoder_hidden_states: Tensor,
+        past_key_values: PastKeyValues,
+        logits: Tensor,
+        pool: Optional[Tuple[int, int]] = None,
+        num_warmup_steps: int = 3,
+    ):
+        self.model = model
+        self.input_ids = input_ids
+        self.parents = parents
+        self.encoder_hidden_states = encoder_hidden_states
+        self.past_key_values = past_key_values
+        self.logits = logits
+
+        # Warm up on a side stream before capturing, so that cuBLAS workspaces and
+        # other lazily initialized state exist before the graph is recorded. Warmup
+        # reorders the cache too, so keep a copy of it to restore afterwards.
+        cache = [x.clone() for layer in past_key_values for x in layer]
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(num_warmup_steps):
+                self._forward()
+        torch.cuda.current_stream().wait_stream(stream)
+        for x, y in zip((x for layer in past_key_values for x in layer), cache):
+            x.copy_(y)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph, pool=pool):
+            self._forward()
+
+    def _forward(self) -> None:
+        cache_len = self.past_key_values[0][0].size(-2) - 1
+        past_key_values = tuple(
+            tuple(x[:, :, :cache_len] for x in layer) for layer in self.past_key_values
+        )
+        for layer in past_key_values:
+            for x in layer:
+                x.copy_(x.index_select(0, self.parents))
+
+        outputs = self.model(
+            self.input_ids,
+            self.encoder_hidden_states,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        self.logits.copy_(outputs.logits)
+        for static_layer, layer in zip(self.past_key_values, outputs.past_key_values):
+            for static, x in zip(static_layer, layer):
+                static[:, :, cache_len:].copy_(x[:, :, cache_len:])
+
+    def replay(self) -> Tuple[Tensor, PastKeyValues]:
+        self.graph.replay()
+        # NOTE: Outputs are static buffers, shared with other graphs. They're
+        # overwritten by the next replay, so they must be consumed (or copied) before
+        # then.
+        return self.logits, self.past_key_values
+
+
 class DecoderInferenceModel:
     _model_path = "model.pt"
     _tokenizer_path = "tokenizer.pkl"
+    # Checking whether beam search can stop early requires a device-to-host sync,
+    # so it's only checked once every few steps.
+    _finished_check_interval = 4
+    # Maximum number of captured CUDA graphs. There's one graph per batch size and
+    # cache length, e.g. 'max_len - 2' graphs to caption with one 'beam_size'. Steps
+    # without a graph run eagerly once the limit is reached. (Evicting graphs instead
+    # would thrash, since every caption steps through all cache lengths in order.)
+    _max_cuda_graphs = 512
 
     def __init__(
         self,
         model: Decoder,
-        tokenizer: GPT2Tokenizer,
+        tokenizer: TokenizerType,
+        use_cuda_graphs: bool = False,
+        compile: bool = False,
+        inference_dtype: Optional[torch.dtype] = None,
     ):
         self.model = model.eval()
         self.tokenizer = tokenizer
+        # Special token IDs are looked up through the vocabulary on every access, so
+        # cache them as plain ints.
+        self._bos_token_id: int = tokenizer.bos_token_id
+        self._eos_token_id: int = tokenizer.eos_token_id
+        # Weights are kept in this precision for inference, rather than running FP32
+        # weights under autocast. See 'inference_dtype' for the default. 'model' may
+        # be shared (e.g. with a training loop), so it's only cast by 'to' and 'load'.
+        self._inference_dtype = inference_dtype
+        # Optionally compile the decoder with 'torch.compile' (PyTorch 2.0+), which
+        # fuses elementwise ops and uses CUDA graphs internally. The compiled module
+        # is kept separately, so 'self.model' can still be saved as usual.
+        self._compiled_model: Optional[Callable] = None
+        if compile:
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("'compile=True' requires PyTorch 2.0 or later.")
+            self._compiled_model = torch.compile(self.model, mode="reduce-overhead")
+        # Decoding steps are small, and mostly bound by kernel launch overhead. When
+        # enabled, each step is captured as a CUDA graph (one per batch size and
+        # cache length), and replayed on subsequent calls. All graphs share the same
+        # static input/output buffers (see '_reserve_graph_inputs') and memory pool,
+        # so memory grows linearly with 'max_len', not with the number of graphs.
+        self.use_cuda_graphs = use_cuda_graphs
+        self._cuda_graphs: Dict[Tuple[int, int], _DecodeStepGraph] = {}
+        self._graph_inputs: Dict[str, Union[Tensor, PastKeyValues]] = {}
+        self._graph_pool: Optional[Tuple[int, int]] = None
+        # Encoder features for each beam, reused across decoding steps and calls.
+        self._encoder_hidden_buf: Optional[Tensor] = None
+        # Original (unquantized) language model, after 'quantize_int8'.
+        self._float_language_model: Optional[nn.Module] = None
 
     @property
     def device(self) -> torch.device:
         return next(self.model.parameters()).device
 
+    @property
+    def dtype(self) -> torch.dtype:
+        return next(self.model.parameters()).dtype
+
+    @property
+    def inference_dtype(self) -> torch.dtype:
+        """Precision of the model weights during inference. Unless specified, uses
+        FP16 on CUDA devices, and FP32 otherwise (half-precision matmuls are slow,
+        or unsupported, on most CPUs).
+        """
+        if self._inference_dtype is not None:
+            return self._inference_dtype
+        return torch.float16 if self.device.type == "cuda" else torch.float32
+
     def to(self, device: torch.device) -> DecoderInferenceModel:
+        """Moves the model to 'device', and casts its weights to 'inference_dtype'
+        (in place, like 'nn.Module.to').
+        """
+        if self.quantized and torch.device(device).type != "cpu":
+            # Dynamic quantization is CPU-only, so go back to the original weights.
+            self.model.language_model = self._float_language_model
+            self._float_language_model = None
         self.model.to(device)
+        self.model.to(dtype=self.inference_dtype)
+        # Captured graphs are tied to the memory they were recorded with.
+        self._cuda_graphs.clear()
+        self._graph_inputs.clear()
         return self
 
+    @property
+    def quantized(self) -> bool:
+        return self._float_language_model is not None
+
+    def quantize_int8(self) -> DecoderInferenceModel:
+        """Dynamically quantizes the linear layers of the language model to INT8,
+        which speeds up CPU inference (especially with AVX-512 VNNI). Does nothing
+        for models on other devices. The original weights are kept, so they can be
+        saved, or restored when moving the model to another device.
+        """
+        if self.quantized or self.device.type != "cpu":
+            return self
+
+        language_model = copy.deepcopy(self.model.language_model).float()
+        _conv1d_to_linear(language_model)
+        torch.ao.quantization.quantize_dynamic(
+            language_model, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        self._float_language_model = self.model.language_model
+        self.model.language_model = language_model
+        return self
+
+    def fuse_encoder_padding(self, num_features: int) -> DecoderInferenceModel:
+        """Folds the zero-padding of encoder features (of size 'num_features') into
+        the cross-attention weights, so it isn't done on every decoding step. See
+        'Decoder.fuse_encoder_padding'. Modifies the wrapped 'Decoder' in place, so
+        it can't be trained (or load unfused checkpoints) afterwards.
+        """
+        if self.quantized:
+            raise RuntimeError("Fuse encoder padding before calling 'quantize_int8'.")
+        self.model.fuse_encoder_padding(num_features)
+        self._cuda_graphs.clear()
+        return self
+
+    def _get_encoder_hidden_buffer(self, x: Tensor, beam_size: int) -> Tensor:
+        """Copies the features 'x' into a persistent buffer with one row per beam,
+        and returns the first 'beam_size' rows. Keeping the same buffer gives CUDA
+        graphs a stable address to read from, so it's only reallocated when a call
+        needs a larger (or otherwise incompatible) one.
+
+        The buffer is as wide as the cross-attention input, and zero beyond the
+        features of 'x', so 'Decoder.forward' doesn't need to pad it every step.
+        """
+        num_features, hidden_size = x.size(-1), self.model.encoder_hidden_size
+        if num_features > hidden_size:
+            raise ValueError(
+                f"Expected encoder features of size at most {hidden_size}, but got "
+                f"size {num_features}."
+            )
+        buf = self._encoder_hidden_buf
+        if (
+            buf is None
+            or buf.size(0) < beam_size
+            or buf.size(-1) != hidden_size
+            or buf.device != self.device
+            or buf.dtype != self.dtype
+        ):
+            buf = torch.zeros(
+                beam_size, 1, hidden_size, device=self.device, dtype=self.dtype
+            )
+            self._encoder_hidden_buf = buf
+            # Captured graphs still read from the old buffer.
+            self._cuda_graphs.clear()
+
+        buf = buf[:beam_size]
+        if x.dim() != 3:
+            x = x.reshape(1, 1, -1)
+        # Broadcasts across beams, and casts to the buffer's device/dtype if needed.
+        buf[..., :num_features].copy_(x)
+        if num_features < hidden_size:
+            # Clear any wider features from a previous call (once per call, rather
+            # than padding on every decoding step).
+            buf[..., num_features:].zero_()
+        return buf
+
+    @property
+    def _graphs_enabled(self) -> bool:
+        # 'torch.compile' manages its own CUDA graphs, so don't capture them twice.
+        compiled = self._compiled_model is not None
+        return self.use_cuda_graphs and self.device.type == "cuda" and not compiled
+
+    def _reserve_graph_inputs(self, beam_size: int, max_len: int) -> None:
+        """Allocates the static input/output buffers shared by all captured graphs,
+        with room for 'beam_size' beams and 'max_len' cached tokens. Each graph reads
+        from (and writes to) a slice of these buffers, so memory doesn't grow with
+        the number of graphs. Buffers are reallocated (and graphs dropped) only if
+        they're too small.
+        """
+        inputs = self._graph_inputs
+        if inputs:
+            input_ids: Tensor = inputs["input_ids"]  # type: ignore
+            key: Tensor = inputs["past_key_values"][0][0]  # type: ignore
+            if (
+                input_ids.size(0) >= beam_size
+                and key.size(-2) >= max_len
+                and key.device == self.device
+                and key.dtype == self.dtype
+            ):
+                return
+            beam_size = max(beam_size, input_ids.size(0))
+            max_len = max(max_len, key.size(-2))
+
+        config = self.model.language_model.config
+        shape = (beam_size, config.n_head, max_len, config.n_embd // config.n_head)
+        self._graph_inputs = {
+            "input_ids": torch.zeros(
+                beam_size, 1, dtype=torch.long, device=self.device
+            ),
+            "parents": torch.zeros(beam_size, dtype=torch.long, device=self.device),
+            "past_key_values": tuple(
+                tuple(
+                    torch.zeros(shape, dtype=self.dtype, device=self.device)
+                    for _ in range(2)
+                )
+                for _ in range(config.n_layer)
+            ),
+            "logits": torch.zeros(
+                beam_size, 1, config.vocab_size, dtype=self.dtype, device=self.device
+            ),
+        }
+        # Captured graphs still read from the old buffers.
+        self._cuda_graphs.clear()
+
+    def _decode_step(
+        self,
+        input_ids: Tensor,
+        encoder_hidden_states: Tensor,
+        past_key_values: Optional[PastKeyValues] = None,
+        parents: Optional[Tensor] = None,
+    ) -> Tuple[Tensor, PastKeyValues]:
+        """Runs the decoder on 'input_ids', reusing the cached 'past_key_values' from
+        the previous step. Row 'i' continues the beam 'parents[i]' of the previous
+        step (or beam 'i', if 'parents' isn't given). Returns the output logits and
+        the updated cache. Steps with a cache are replayed from a CUDA graph, if
+        'use_cuda_graphs' is set. The first step is always run eagerly, since there
+        is nothing to replay it with, and so are new steps once '_max_cuda_graphs'
+        graphs have been captured.
+        """
+        batch_size = input_ids.size(0)
+        cache_len = 0 if past_key_values is None else past_key_values[0][0].size(-2)
+        key = (batch_size, cache_len)
+        use_graph = (
+            past_key_values is not None
+            and self._graphs_enabled
+            and (
+                key in self._cuda_graphs
+                or len(self._cuda_graphs) < self._max_cuda_graphs
+            )
+        )
+        if not use_graph:
+            if past_key_values is not None and parents is not None:
+                past_key_values = tuple(
+                    tuple(x.index_select(0, parents) for x in layer)
+                    for layer in past_key_values
+                )
+            model = self.model if self._compiled_model is None else self._compiled_model
+            outputs = model(
+                input_ids,
+                encoder_hidden_states,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            return outputs.logits, outputs.past_key_values
+
+        # Only the new token IDs and parent beams are copied into the static buffers
+        # shared by all graphs. The cache slices have room for this step's token.
+        inputs = self._graph_inputs
+        static_input_ids = inputs["input_ids"][:batch_size]  # type: ignore
+        static_input_ids.copy_(input_ids)
+        static_parents = inputs["parents"][:batch_size]  # type: ignore
+        if parents is None:
+            parents = torch.arange(batch_size, device=self.device)
+        static_parents.copy_(parents)
+        static_past = tuple(
+            tuple(static[:batch_size, :, : cache_len + 1] for static in static_layer)
+            for static_layer in inputs["past_key_values"]  # type: ignore
+        )
+        if past_key_values[0][0].data_ptr() != static_past[0][0].data_ptr():
+            # The previous step ran eagerly, so its cache isn't in the static buffers.
+            for static_layer, layer in zip(static_past, past_key_values):
+                for static, x in zip(static_layer, layer):
+                    static[: x.size(0), :, :cache_len].copy_(x)
+
+        if key not in self._cuda_graphs:
+            if not self._cuda_graphs:
+                # Graphs only keep temporaries in their memory pool (outputs go to
+                # static buffers), and never replay concurrently, so they can all
+                # share one pool.
+                self._graph_pool = torch.cuda.graph_pool_handle()
+            self._cuda_graphs[key] = _DecodeStepGraph(
+                self.model,
+                static_input_ids,
+                static_parents,
+                encoder_hidden_states,
+                static_past,
+                inputs["logits"][:batch_size],  # type: ignore
+                pool=self._graph_pool,
+            )
+        return self._cuda_graphs[key].replay()
+
     def save(self, path: str):
+        # Quantized weights aren't saved. Save the original weights instead, and
+        # quantize them again when loading.
+        quantized_language_model = None
+        if self.quantized:
+            quantized_language_model = self.model.language_model
+            self.model.language_model = self._float_language_model
+
         # Save a copy of the current model weights, and cast to FP16 for storage
         model_state_dict = self.model.state_dict()
+        dtype = self.dtype
+        self.model.to(dtype=torch.float16)
         # Avoid saving any cached properties of this class or its subclasses :)
-        obj = self.__class__(model=self.model.half(), tokenizer=self.tokenizer)
+        obj = self.__class__(
+            model=self.model, tokenizer=self.tokenizer, inference_dtype=torch.float16
+        )
+        obj._quantize_on_load = quantized_language_model is not None
         torch.save(obj, path)
-        # Restore the original model weights
+        # Restore the original model weights, in the original precision
+        self.model.to(dtype=dtype)
         self.model.load_state_dict(model_state_dict)
+        self._cuda_graphs.clear()
+        if quantized_language_model is not None:
+            self.model.language_model = quantized_language_model
 
     @classmethod
-    def load(cls, path: str) -> DecoderInferenceModel:
-        temp = torch.load(path)
+    def load(
+        cls,
+        path: str,
+        map_location: Optional[Union[str, torch.device]] = None,
+        num_encoder_features: Optional[int] = None,
+    ) -> DecoderInferenceModel:
+        """Loads an inference model saved with 'save', specialized for encoder
+        features of size 'num_encoder_features' (see 'fuse_encoder_padding'). By
+        default, that's the size of the features from the model's vision backbone.
+        """
+        kwargs = {}
+        load_params = inspect.signature(torch.load).parameters
+        if "mmap" in load_params:
+            # PyTorch 2.1+ can memory-map the archive, so weights are paged in on
+            # demand, rather than reading the whole file into memory up front.
+            kwargs["mmap"] = True
+        if "weights_only" in load_params:
+            # The archive contains a pickled inference model (not just weights).
+            kwargs["weights_only"] = False
+        temp = torch.load(path, map_location=map_location, **kwargs)
         # Just in case we change any of the class methods here, unpack the model
-        # and tokenizer, and pass them into a new instance of this class.
-        return cls(model=temp.model.float(), tokenizer=temp.tokenizer)
+        # and tokenizer, and pass them into a new instance of this class. Older
+        # archives (e.g. the pretrained model) contain a slow tokenizer, which is
+        # converted to a fast one.
+        tokenizer = to_fast_tokenizer(temp.tokenizer)
+        obj = cls(model=temp.model, tokenizer=tokenizer)
+        # Weights are stored in FP16. The loaded model isn't shared, so cast it here.
+        obj.model.to(dtype=obj.inference_dtype)
+        if num_encoder_features is None:
+            num_encoder_features = get_vision_backbone_features(
+                obj.model.vision_backbone
+            )
+        # The unpickled model isn't shared with anything else (e.g. an optimizer),
+        # so it's safe to specialize its weights here.
+        if num_encoder_features < obj.model.encoder_hidden_size:
+            obj.fuse_encoder_padding(num_encoder_features)
+        if getattr(temp, "_quantize_on_load", False):
+            obj.quantize_int8()
+        return obj
 
     @classmethod
     def download_pretrained(cls, dest: str = None) -> DecoderInferenceModel:
-        with tempfile.TemporaryDirectory() as tempdir:
-            if dest is None:
-                dest = os.path.join(tempdir, "model.zip")
-            gdown.download(PRETRAINED_INFERENCE_MODEL_PATH, dest, quiet=False)
-            return cls.load(dest)
-
-    @torch.cuda.amp.autocast()
-    @torch.no_grad()
-    def __call__(self, x: Tensor, max_len: int = 64, beam_size: int = 1) -> str:
+        if dest is None:
+            # Cache downloads by URL, so they're only downloaded once.
+            url_hash = hashlib.sha256(PRETRAINED_INFERENCE_MODEL_PATH.encode())
+            dest = os.path.join(CACHE_DIR, f"{url_hash.hexdigest()}.pt")
+        download_file(PRETRAINED_INFERENCE_MODEL_PATH, dest)
+        return cls.load(dest)
+
+    @torch.inference_mode()
+    def __call__(
+        self,
+        x: Tensor,
+        max_len: int = 64,
+        beam_size: int = 1,
+        length_penalty: float = 0.0,
+    ) -> str:
         """Inference using beam search. For beam search, we predict one token per step.
         After each step, we keep only the 'beam_size' output sequences with the highest
         end-to-end confidence score. Repeat this process until at most 'max_len' tokens
         have been generated.
+
+        'x' contains the encoder features for a single input. Any shape with one row
+        of features is accepted, but a (1, 1, num_features) Tensor already on this
+        model's device and dtype avoids any reshaping or conversion.
+
+        Beams are ranked by 'total_logprob / length ** length_penalty', where 'length'
+        is the number of generated tokens (including the "stop" token, but not the
+        "start" token). The default (0.0) ranks by total log-probability, and larger
+        values favor longer text.
         """
-        encoder_hidden_states = x.reshape(1, 1, -1).to(self.device)
-        # Since we haven't performed any beam search steps yet, we just have one
-        # set of input IDs (with a single "start" token). We use 'None' for the log
-        # probability of this sequence, since it's not being predicted by the model.
-        input_ids = [torch.tensor([self.tokenizer.bos_token_id], device=self.device)]
-        beam_logprobs: Optional[List[float]] = None
-
-        def _get_beam_outputs(_input_ids: Tensor) -> Tuple[List[Tensor], Tensor]:
-            """Performs inference on the 'input_ids' Tensor, and collects the top
-            'beam_size' results by score. Returns a list of output Tensors, and
-            their respective log-probabilities.
-            """
-            outputs = self.model(_input_ids.unsqueeze(0), encoder_hidden_states)
-            logits: Tensor = outputs.logits[0, -1]
-            logprobs = F.log_softmax(logits, dim=-1)
-
-            topk_logprobs = logprobs.topk(k=beam_size)
-            indices = topk_logprobs.indices
-            logprobs = topk_logprobs.values
-            output_ids = [
-                torch.cat([_input_ids, idx.reshape(-1)], dim=0) for idx in indices
-            ]
-
-            return output_ids, logprobs
-
-        for _ in range(max_len - 1):
-            output_ids: List[Tensor] = []
-            logprobs: List[float] = []
-            beams_done: List[bool] = []
-
-            # Collect the top 'beam_size' results from each beam individually.
-            for beam_idx, ids in enumerate(input_ids):
-                # If 'beam_logprobs' is already defined, then we've predicted at least
-                # one token already. And if the last token is equal to the "stop" token,
-                # we don't need to perform inference with this beam anymore.
-                if beam_logprobs and ids[-1].item() == self.tokenizer.eos_token_id:
-                    output_ids.append(ids)
-                    logprobs.append(beam_logprobs[beam_idx])
-                    beams_done.append(True)
-                    continue
-
-                _output_ids, _logprobs = _get_beam_outputs(ids)
-                if beam_logprobs is not None:
-                    # Sum the log-probabilities of the existing beam and our predicted
-                    # token to get the total log-probability.
-                    _logprobs += beam_logprobs[beam_idx]
-
-                # Append the results from this beam to the aggregate lists.
-                output_ids += _output_ids
-                logprobs += _logprobs.tolist()
-                beams_done.append(False)
-
-            if all(beams_done):
-                # All search beams are done generating text.
-                break
-
-            # Keep only the top 'beam_size' beams by total log-probability.
-            indices = torch.tensor(logprobs).topk(k=beam_size).indices
-            input_ids = [output_ids[idx] for idx in indices]
-            beam_logprobs = [logprobs[idx] for idx in indices]
-
-        # Find the predicted beam with highest overall log-probability.
-        best_beam_idx: int = torch.tensor(beam_logprobs).argmax().item()  # type: ignore
+        token_ids = self._beam_search(
+            x, max_len=max_len, beam_size=beam_size, length_penalty=length_penalty
+        )
         # Decode the predicted token IDs into a text string.
-        return self.tokenizer.decode(input_ids[best_beam_idx], skip_special_tokens=True)
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+    @torch.inference_mode()
+    def _beam_search(
+        self,
+        x: Tensor,
+        max_len: int = 64,
+        beam_size: int = 1,
+        length_penalty: float = 0.0,
+    ) -> List[int]:
+        """Returns the token IDs of the best beam (see '__call__'), starting with the
+        "start" token, and ending with the "stop" token if one was generated.
+        """
+        encoder_hidden_states = self._get_encoder_hidden_buffer(x, beam_size)
+        if self._graphs_enabled:
+            self._reserve_graph_inputs(beam_size, max_len)
+        eos_token_id = self._eos_token_id
+        # Preallocate the token IDs, lengths, and total log-probabilities of all beams
+        # (one row per beam), so the decoding loop only updates them in place. Since
+        # we haven't performed any beam search steps yet, we just have one beam (with
+        # a single "start" token) and no cached keys/values. All beams are stacked
+        # into a single batch, and each step runs one forward pass.
+        #
+        # Unused positions hold the "stop" token, which is skipped when decoding.
+        token_buf = torch.full(
+            (beam_size, max_len), eos_token_id, dtype=torch.long, device=self.device
+        )
+        token_buf[:, 0] = self._bos_token_id
+        # Number of generated tokens in each beam, up to (and including) its "stop"
+        # token. The "start" token isn't counted.
+        lengths = torch.zeros(beam_size, dtype=torch.long, device=self.device)
+        cum_logprob_buf = torch.zeros(beam_size, device=self.device)
+        # Beams that have generated the "stop" token are done generating text.
+        finished = torch.zeros(beam_size, dtype=torch.bool, device=self.device)
+        # Beams are kept (or dropped) by total log-probability, but ranked by their
+        # length-normalized score. So with a 'length_penalty', the best finished beam
+        # can be dropped from the beams. Like the finished hypotheses of standard beam
+        # search, the best one is kept here, on device.
+        best_finished_score = torch.full((), -float("inf"), device=self.device)
+        best_finished_ids = token_buf[0].clone()
+        best_finished_length = lengths[0].clone()
+        done_logprobs: Optional[Tensor] = None
+        past: Optional[PastKeyValues] = None
+        parents: Optional[Tensor] = None
+        num_beams, num_tokens = 1, 1
+
+        while num_tokens < max_len:
+            if num_tokens % self._finished_check_interval == 0:
+                # Total log-probabilities (which are negative) only decrease as beams
+                # grow, so the best score a live beam can reach is its current total
+                # log-probability, normalized by the length that favors it most. That
+                # is the maximum length, or its current length if 'length_penalty' is
+                # negative. Stop when no live beams can overtake the best finished
+                # beam (or when all beams are finished).
+                if length_penalty >= 0:
+                    live_bounds = cum_logprob_buf / (max_len - 1) ** length_penalty
+                else:
+                    live_bounds = cum_logprob_buf / lengths.float() ** length_penalty
+                best_live = live_bounds.masked_fill(finished, -float("inf")).max()
+                if best_finished_score >= best_live:
+                    break
+
+            logits, past = self._decode_step(
+                token_buf[:num_beams, num_tokens - 1 : num_tokens],
+                encoder_hidden_states[:num_beams],
+                past,
+                parents,
+            )
+            # Accumulate log-probabilities in FP32, even if the model runs in FP16.
+            logits = logits[:, -1].float()
+            if done_logprobs is None:
+                # Finished beams can only be extended by another "stop" token, which
+                # leaves their total log-probability unchanged.
+                done_logprobs = torch.full_like(logits[0], -float("inf"))
+                done_logprobs[eos_token_id] = 0
+            logits = torch.where(finished[:num_beams, None], done_logprobs, logits)
+
+            # Sum the log-probabilities of the existing beams and our predicted
+            # tokens, and keep the top 'beam_size' candidates across all beams.
+            # Since log_softmax(x) = x - logsumexp(x), the normalizer is folded into
+            # one offset per beam instead of computing a full log-softmax. Beam order
+            # doesn't matter (the final beam is chosen with 'argmax'), so skip sorting.
+            vocab_size = logits.size(-1)
+            offsets = cum_logprob_buf[:num_beams] - logits.logsumexp(dim=-1)
+            scores = (logits + offsets[:, None]).view(-1)
+            topk_scores, indices = scores.topk(k=beam_size, sorted=False)
+            parents = torch.div(indices, vocab_size, rounding_mode="floor")
+            tokens = indices % vocab_size
+
+            # The cache is reordered by 'parents' in the next decoding step.
+            token_buf[:, :num_tokens] = token_buf[parents, :num_tokens]
+            token_buf[:, num_tokens] = tokens
+            cum_logprob_buf.copy_(topk_scores)
+            was_finished = finished[parents]
+            lengths = lengths[parents] + (~was_finished).long()
+            finished = was_finished | (tokens == eos_token_id)
+            num_beams, num_tokens = beam_size, num_tokens + 1
+
+            # Keep the beam that just finished with the best score, if it beats the
+            # best finished beam so far.
+            scores = cum_logprob_buf / lengths.float() ** length_penalty
+            scores = scores.masked_fill(~finished | was_finished, -float("inf"))
+            idx = scores.argmax()
+            better = scores[idx] > best_finished_score
+            best_finished_score = torch.where(better, scores[idx], best_finished_score)
+            best_finished_ids = torch.where(better, token_buf[idx], best_finished_ids)
+            best_finished_length = torch.where(
+                better, lengths[idx], best_finished_length
+            )
+
+        # Choose between the best finished beam, and the best unfinished beam (if we
+        # ran out of 'max_len'). Selecting on device means only the final length and
+        # token IDs are copied back to the host, in a single transfer.
+        scores = cum_logprob_buf / lengths.clamp(min=1).float() ** length_penalty
+        scores = scores[:num_beams].masked_fill(finished[:num_beams], -float("inf"))
+        idx = scores.argmax()
+        use_finished = best_finished_score >= scores[idx]
+        best_length = torch.where(use_finished, best_finished_length, lengths[idx])
+        best_ids = torch.where(use_finished, best_finished_ids, token_buf[idx])
+        best_length, *best_ids = torch.cat(
+            [best_length[None], best_ids[:num_tokens]]
+        ).tolist()
+        # Include the "start" token, which isn't counted in 'lengths'.
+        return best_ids[: best_length + 1]
 
 
 class ImageCaptionInferenceModel(DecoderInferenceModel):
-    def __init__(self, model: Decoder, tokenizer: GPT2Tokenizer):
-        super().__init__(model, tokenizer)
+    def __init__(
+        self,
+        model: Decoder,
+        tokenizer: TokenizerType,
+        use_cuda_graphs: bool = False,
+        compile: bool = False,
+        inference_dtype: Optional[torch.dtype] = None,
+    ):
+        super().__init__(
+            model,
+            tokenizer,
+            use_cuda_graphs=use_cuda_graphs,
+            compile=compile,
+            inference_dtype=inference_dtype,
+        )
         self._vision_backbone: Optional[nn.Module] = None
         self._preprocessor: Optional[Callable] = None
+        # Image features, keyed by 'id(image)'. Entries are evicted when the image
+        # is garbage collected, so captioning the same image again (e.g. with a
+        # different 'beam_size') skips the vision backbone.
+        self._feature_cache: Dict[int, Tensor] = {}
 
     def _load_vision_backbone(self):
-        backbone, preprocessor = load_vision_backbone(self.model.vision_backbone)
+        backbone, preprocessor = load_vision_backbone(
+            self.model.vision_backbone, device=self.device
+        )
+        if self.device.type == "cuda":
+            # 'clip.load' already returns FP16 conv/linear weights on CUDA, and keeps
+            # LayerNorm in FP32 (its 'forward' upcasts inputs to FP32), so don't call
+            # '.half()' here. Convolutions (e.g. the ViT patch embedding) are faster
+            # in channels-last, though.
+            backbone = backbone.to(memory_format=torch.channels_last)
+            if isinstance(backbone, CLIP):
+                # Only decode images on the CPU, and preprocess them on the GPU.
+                resolution = backbone.visual.input_resolution
+                preprocessor = load_clip_tensor_preprocessor(resolution, self.device)
         self._vision_backbone = backbone
         self._preprocessor = preprocessor
 
@@ -255,18 +831,61 @@ class ImageCaptionInferenceModel(DecoderInferenceModel):
         assert self._preprocessor is not None
         return self._preprocessor
 
-    @torch.cuda.amp.autocast()
-    @torch.no_grad()
+    def to(self, device: torch.device) -> ImageCaptionInferenceModel:
+        super().to(device)
+        # Reload the vision backbone lazily, with the right precision for 'device'.
+        self._vision_backbone = None
+        self._preprocessor = None
+        self._feature_cache.clear()
+        return self
+
+    @torch.inference_mode()
+    def encode_images(self, images: Sequence[Image.Image]) -> Tensor:
+        """Encodes a batch of images with the vision backbone, in a single forward
+        pass. Returns a Tensor of image features with shape (num_images, features).
+        """
+        backbone = self.vision_backbone
+        # Not the first parameter's dtype: CLIP keeps some parameters (e.g. its
+        # positional embeddings) in FP32, even when the image encoder is FP16.
+        dtype = getattr(backbone, "dtype", next(backbone.parameters()).dtype)
+        preprocessed = torch.stack([self.preprocessor(image) for image in images])
+        preprocessed = preprocessed.to(self.device, dtype).contiguous(
+            memory_format=torch.channels_last
+        )
+        return encode_image_tensor(preprocessed, backbone)
+
+    def _encode_image(self, image: Image.Image) -> Tensor:
+        key = id(image)
+        if key not in self._feature_cache:
+            # Store features in the shape and dtype expected by the decoder.
+            encoded = self.encode_images([image]).view(1, 1, -1)
+            self._feature_cache[key] = encoded.to(self.dtype)
+            weakref.finalize(image, self._feature_cache.pop, key, None)
+        return self._feature_cache[key]
+
+    @torch.inference_mode()
     def __call__(
         self,
-        image: Union[str, Image.Image],
+        image: Union[str, Image.Image, Tensor],
         max_len: int = 64,
         beam_size: int = 1,
-        encoded=None
+        encoded: Optional[Tensor] = None,
+        length_penalty: float = 0.0,
     ) -> str:
-        if isinstance(image, str):
-            image = Image.open(image)
-
-        preprocessed: Tensor = self.preprocessor(image).to(self.device)
-        encoded = encode_image_tensor(preprocessed.unsqueeze(0), self.vision_backbone)
-        return super().__call__(encoded, max_len=max_len, beam_size=beam_size)
+        """Generates a caption for 'image', which can be a file path, a PIL image, or
+        precomputed image features (e.g. from 'encode_images'). Features can also be
+        passed explicitly through 'encoded'.
+        """
+        if encoded is None and isinstance(image, Tensor):
+            encoded = image
+        elif encoded is None:
+            if isinstance(image, str):
+                image = Image.open(image)
+            encoded = self._encode_image(image)
+
+        return super().__call__(
+            encoded,
+            max_len=max_len,
+            beam_size=beam_size,
+            length_penalty=length_penalty,
+        )
@@ -0,0 +1,45 @@
+import os
+from typing import Optional
+
+import requests
+from tqdm import tqdm
+
+
+def download_file(url: str, path: str, chunk_size: int = 2**20) -> str:
+    """Streams the file at 'url' to 'path', and returns 'path'. Existing files are
+    reused as-is, and interrupted downloads are resumed with an HTTP Range request.
+    """
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    partial_path = f"{path}.part"
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    # Skip the Google Drive confirmation page for files too large to virus-scan.
+    params = {"export": "download", "confirm": "t"} if "drive.google" in url else {}
+
+    with requests.get(
+        url, params=params, headers=headers, stream=True, timeout=30
+    ) as response:
+        response.raise_for_status()
+        if response.headers.get("Content-Type", "").startswith("text/html"):
+            raise RuntimeError(f"Expected a file from '{url}', but got an HTML page.")
+        if response.status_code != 206:
+            # The server ignored our Range request, so start from the beginning.
+            offset = 0
+
+        length: Optional[int] = None
+        if "Content-Length" in response.headers:
+            length = offset + int(response.headers["Content-Length"])
+        with open(partial_path, "ab" if offset else "wb") as f, tqdm(
+            total=length, initial=offset, unit="B", unit_scale=True, desc=url
+        ) as progress:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                progress.update(len(chunk))
+
+    if length is not None and os.path.getsize(partial_path) != length:
+        raise IOError(f"Incomplete download from '{url}'. Try again to resume it.")
+    os.replace(partial_path, path)
+    return path
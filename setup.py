@@ -26,9 +26,9 @@ setup(
     long_description_content_type="text/markdown",
     install_requires=[
         "evaluate",
-        "gdown",
         "numpy",
         "pytorch-lightning",
+        "requests",
         "spacy",
         "torch>=1.11",
         "torchdata>=0.3.0",
@@ -1,12 +1,16 @@
 import os
 import tempfile
 from functools import lru_cache
+from typing import List, Tuple
 
 import pytest
 import torch
+from clip.clip import _transform as clip_transform
 from PIL import Image
+from torch import Tensor, nn
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer, GPT2TokenizerFast
 
-from clip_text_decoder.common import load_tokenizer
+from clip_text_decoder.common import load_clip_tensor_preprocessor, load_tokenizer
 from clip_text_decoder.model import (
     Decoder,
     DecoderInferenceModel,
@@ -42,6 +46,46 @@ def test_model_forward(language_model: str):
     assert out_size == vocab_size
 
 
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_model_fuse_encoder_padding(language_model: str):
+    model = Decoder(language_model=language_model).eval()
+    tokenizer = get_tokenizer(language_model)
+
+    device = model.device
+    vocab_size = len(tokenizer)
+    BATCH_SIZE, SEQ_LEN, EMBEDDING_DIM = 1, 16, 512
+    input_ids = torch.randint(0, vocab_size, size=(BATCH_SIZE, SEQ_LEN), device=device)
+    encoder_hidden_states = torch.randn(BATCH_SIZE, 1, EMBEDDING_DIM, device=device)
+
+    with torch.no_grad():
+        expected = model.forward(input_ids, encoder_hidden_states).logits
+        model.fuse_encoder_padding(EMBEDDING_DIM)
+        out = model.forward(input_ids, encoder_hidden_states).logits
+    assert model.encoder_hidden_size == EMBEDDING_DIM
+    torch.testing.assert_close(out, expected)
+
+    wider = torch.randn(BATCH_SIZE, 1, EMBEDDING_DIM + 1, device=device)
+    with pytest.raises(ValueError):
+        model.forward(input_ids, wider)
+
+
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_inference_model_fuse_encoder_padding(language_model: str):
+    model = Decoder(language_model=language_model).eval()
+    tokenizer = get_tokenizer(language_model)
+    inference_model = DecoderInferenceModel(model=model, tokenizer=tokenizer)
+    hidden_size = model.encoder_hidden_size
+
+    EMBEDDING_SIZE = 512
+    memory = torch.randn(1, 1, EMBEDDING_SIZE)
+    expected = inference_model(memory, beam_size=2)
+    # Inference alone doesn't modify the wrapped model.
+    assert model.encoder_hidden_size == hidden_size
+    inference_model.fuse_encoder_padding(EMBEDDING_SIZE)
+    assert model.encoder_hidden_size == EMBEDDING_SIZE
+    assert inference_model(memory, beam_size=2) == expected
+
+
 @pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
 def test_inference_model_forward(language_model: str):
     model = Decoder(language_model=language_model).eval()
@@ -54,6 +98,143 @@ def test_inference_model_forward(language_model: str):
     assert isinstance(text, str)
 
 
+def _reference_beam_search(
+    model: Decoder,
+    x: Tensor,
+    bos: int,
+    eos: int,
+    max_len: int,
+    beam_size: int,
+    length_penalty: float = 0.0,
+) -> List[int]:
+    """Brute-force beam search, which runs the full prefix of every beam without
+    any caching. Returns the token IDs of the best beam.
+    """
+
+    def score(logprob: float, ids: List[int]) -> float:
+        # The "start" token doesn't count towards the length.
+        return logprob / (len(ids) - 1) ** length_penalty
+
+    # (total log-probability, token IDs). Finished beams end with the "stop" token.
+    beams = [(0.0, [bos])]
+    best_finished = (-float("inf"), [bos])
+    for _ in range(max_len - 1):
+        # (total log-probability, parent beam index, next token, or None if finished)
+        candidates = []
+        for i, (logprob, ids) in enumerate(beams):
+            if len(ids) > 1 and ids[-1] == eos:
+                candidates.append((logprob, i, None))
+                continue
+            logits = model(torch.tensor([ids]), x).logits[0, -1]
+            logprobs = logits.log_softmax(dim=-1).tolist()
+            candidates.extend((logprob + lp, i, t) for t, lp in enumerate(logprobs))
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        beams = [
+            (logprob, beams[i][1] + ([] if token is None else [token]))
+            for logprob, i, token in candidates[:beam_size]
+        ]
+        # Keep the best finished beam, even if it's dropped from 'beams' later.
+        for (logprob, ids), (_, _, token) in zip(beams, candidates):
+            if token == eos and score(logprob, ids) > best_finished[0]:
+                best_finished = (score(logprob, ids), ids)
+
+    live = [(score(lp, ids), ids) for lp, ids in beams if ids[-1] != eos]
+    best_live = max(live, key=lambda b: b[0], default=(-float("inf"), [bos]))
+    return best_finished[1] if best_finished[0] >= best_live[0] else best_live[1]
+
+
+@pytest.mark.parametrize("beam_size", [1, 3])
+@pytest.mark.parametrize("early_eos", [False, True])
+@pytest.mark.parametrize("length_penalty", [-1.0, 0.0, 1.0])
+def test_inference_model_matches_reference(
+    beam_size: int, early_eos: bool, length_penalty: float
+):
+    torch.manual_seed(0)
+    model = Decoder(language_model="distilgpt2", device="cpu").eval()
+    tokenizer = get_tokenizer("distilgpt2")
+    bos, eos = tokenizer.bos_token_id, tokenizer.eos_token_id
+    # Small, random language model, with large enough weights that the top tokens
+    # aren't close to tied.
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_embd=32,
+        n_layer=2,
+        n_head=2,
+        add_cross_attention=True,
+        initializer_range=0.5,
+    )
+    language_model = GPT2LMHeadModel(config).eval()
+    # Untie the output layer, and give it a bias, so the "stop" token can be made
+    # more likely without affecting the input embeddings.
+    lm_head = nn.Linear(config.n_embd, config.vocab_size)
+    lm_head.weight = language_model.lm_head.weight
+    nn.init.zeros_(lm_head.bias)
+    language_model.lm_head = lm_head
+    model.language_model = language_model
+    inference_model = DecoderInferenceModel(model=model, tokenizer=tokenizer)
+
+    MAX_LEN, EMBEDDING_SIZE = 8, 24
+    memory = torch.randn(1, 1, EMBEDDING_SIZE)
+    with torch.no_grad():
+        if early_eos:
+            # Make the "stop" token a close second in the first step. Greedy search
+            # continues, while beam search finishes one beam right away (which then
+            # beats all of the longer beams).
+            logits = model(torch.tensor([[bos]]), memory).logits[0, -1]
+            top1, top2 = logits.topk(k=2).values
+            lm_head.bias[eos] = top1 - 0.1 * (top1 - top2) - logits[eos]
+        expected = _reference_beam_search(
+            model,
+            memory,
+            bos=bos,
+            eos=eos,
+            max_len=MAX_LEN,
+            beam_size=beam_size,
+            length_penalty=length_penalty,
+        )
+    if early_eos and beam_size > 1 and length_penalty == 0:
+        assert expected == [bos, eos]
+
+    token_ids = inference_model._beam_search(
+        memory, max_len=MAX_LEN, beam_size=beam_size, length_penalty=length_penalty
+    )
+    assert token_ids == expected
+
+
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_inference_model_inference_dtype(language_model: str):
+    model = Decoder(language_model=language_model, device="cpu").eval()
+    tokenizer = get_tokenizer(language_model)
+    inference_model = DecoderInferenceModel(
+        model=model, tokenizer=tokenizer, inference_dtype=torch.bfloat16
+    )
+    # The wrapped model is only cast when moved with 'to'.
+    assert next(model.parameters()).dtype == torch.float32
+    inference_model.to("cpu")
+    assert next(model.parameters()).dtype == torch.bfloat16
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_inference_model_cuda_graphs(language_model: str):
+    model = Decoder(language_model=language_model, device="cuda").eval()
+    tokenizer = get_tokenizer(language_model)
+    inference_model = DecoderInferenceModel(model=model, tokenizer=tokenizer)
+
+    EMBEDDING_SIZE = 512
+    memory = torch.randn(1, 1, EMBEDDING_SIZE)
+    expected = inference_model(memory, beam_size=2)
+    inference_model.use_cuda_graphs = True
+    # Call twice, so that the second call replays the captured graphs.
+    assert inference_model(memory, beam_size=2) == expected
+    assert inference_model(memory, beam_size=2) == expected
+    # Steps beyond the graph limit fall back to eager decoding.
+    inference_model._max_cuda_graphs = 4
+    inference_model._cuda_graphs.clear()
+    assert inference_model(memory, beam_size=2) == expected
+    assert len(inference_model._cuda_graphs) == 4
+
+
 @pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
 def test_inference_model_save(language_model: str):
     model = Decoder(language_model=language_model).eval()
@@ -77,6 +258,92 @@ def test_inference_model_save_load(language_model: str):
         _ = DecoderInferenceModel.load(path)
 
 
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_inference_model_load_fast_tokenizer(language_model: str):
+    model = Decoder(language_model=language_model).eval()
+    tokenizer = GPT2Tokenizer.from_pretrained(language_model)
+    inference_model = DecoderInferenceModel(model=model, tokenizer=tokenizer)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "model.pt")
+        inference_model.save(path)
+        loaded = DecoderInferenceModel.load(path)
+    assert isinstance(loaded.tokenizer, GPT2TokenizerFast)
+    for text in DUMMY_TEXTS:
+        token_ids = tokenizer.encode(text)
+        assert loaded.tokenizer.encode(text) == token_ids
+        assert loaded.tokenizer.decode(token_ids) == tokenizer.decode(token_ids)
+
+
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_inference_model_load_fuses_encoder_padding(language_model: str):
+    model = Decoder(vision_backbone="clip:ViT-B/32", language_model=language_model)
+    tokenizer = get_tokenizer(language_model)
+    inference_model = DecoderInferenceModel(model=model, tokenizer=tokenizer)
+    hidden_size = model.encoder_hidden_size
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "model.pt")
+        inference_model.save(path)
+        loaded = DecoderInferenceModel.load(path)
+    # CLIP ViT-B/32 features have size 512.
+    assert loaded.model.encoder_hidden_size == 512
+    assert model.encoder_hidden_size == hidden_size
+
+
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_inference_model_quantize_int8(language_model: str):
+    model = Decoder(language_model=language_model, device="cpu").eval()
+    tokenizer = get_tokenizer(language_model)
+    inference_model = DecoderInferenceModel(model=model, tokenizer=tokenizer)
+    inference_model.quantize_int8()
+    assert inference_model.quantized
+
+    EMBEDDING_SIZE = 512
+    memory = torch.randn(1, 1, EMBEDDING_SIZE)
+    text = inference_model(memory)
+    assert isinstance(text, str)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "model.pt")
+        inference_model.save(path)
+        loaded = DecoderInferenceModel.load(path)
+        assert loaded.quantized
+
+
+@pytest.mark.parametrize("size", [(300, 400), (640, 480), (1500, 1000)])
+def test_clip_tensor_preprocessor(size: Tuple[int, int]):
+    torch.manual_seed(0)
+    # Smooth random image (more like a photo than pixel noise). Larger images are
+    # shrunk on the CPU before resizing, which should barely change the result.
+    pixels = torch.randint(0, 256, size=(24, 32, 3), dtype=torch.uint8).numpy()
+    image = Image.fromarray(pixels).resize(size, resample=Image.BICUBIC)
+
+    # This is the preprocessor returned by 'clip.load', which uses PIL.
+    expected = clip_transform(224)(image)
+    preprocessed = load_clip_tensor_preprocessor(224, device="cpu")(image)
+    assert preprocessed.shape == expected.shape
+    # One 'uint8' level is about 0.015 after normalization.
+    assert (preprocessed - expected).abs().mean() < 0.02
+    torch.testing.assert_close(preprocessed, expected, atol=0.1, rtol=0)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("language_model", LANGUAGE_MODELS)
+def test_image_caption_model_encode_images(language_model: str):
+    model = Decoder(
+        vision_backbone="clip:ViT-B/32", language_model=language_model, device="cuda"
+    ).eval()
+    tokenizer = get_tokenizer(language_model)
+    inference_model = ImageCaptionInferenceModel(model=model, tokenizer=tokenizer)
+
+    image = Image.new("RGB", (32, 48))
+    encoded = inference_model.encode_images([image, image])
+    assert encoded.shape == (2, 512)
+    assert torch.isfinite(encoded).all()
+    assert isinstance(inference_model(image), str)
+
+
 @pytest.mark.slow
 def test_inference_model_download_pretrained():
     _ = DecoderInferenceModel.download_pretrained()
@@ -89,3 +356,12 @@ def test_image_caption_model_predict():
     pred = model(image)
     assert isinstance(pred, str)
     assert len(pred) > 0
+
+
+@pytest.mark.slow
+def test_image_caption_model_predict_encoded():
+    image = Image.new("RGB", (224, 224))
+    model = ImageCaptionInferenceModel.download_pretrained()
+    encoded = model.encode_images([image, image])
+    assert encoded.shape[0] == 2
+    assert model(encoded[0]) == model(image)